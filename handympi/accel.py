@@ -0,0 +1,18 @@
+#
+# Optional speedups that only kick in when the package providing them is installed.
+#
+
+def jit(f):
+    """
+    Compile 'f' with numba (nopython mode, cached, fastmath) so the slaves
+    run it at C speed. Without numba 'f' is returned unchanged.
+    numba compiles on the first call, but importing it is slow, so decorate
+    where the function is defined for use, not at module level of a library.
+    Use it as a decorator on functions passed to foreach, or called from
+    calcWorkResult.
+    """
+    try:
+        import numba
+    except ImportError:
+        return f
+    return numba.njit(cache=True, fastmath=True)(f)
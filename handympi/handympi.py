@@ -2,7 +2,13 @@
 # Similar to "handythread", but using MPI instead.
 #
 
-import sys
+import inspect
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy
+
+from .accel import jit
 
 HAVE_MPI=0
 HAVE_MPI4PY=0
@@ -11,48 +17,45 @@ MY_RANK=0
 
 try:
     from mpi4py import MPI
+    HAVE_MPI4PY=1
+except ImportError:
+    if DEBUG:
+        import traceback
+        traceback.print_exc()
+
+if HAVE_MPI4PY:
     comm = MPI.COMM_WORLD
-    
-    HAVE_MPI=1
     MY_RANK=comm.Get_rank()
     
     from .mpi4_balancer import MPIWork, MPIBalancer
     
     if comm.Get_size() > 1:
         HAVE_MPI=1  # we have mpi4py, and we're running with more than one node
-        
-    if DEBUG:
-        if HAVE_MPI4PY and HAVE_MPI:
-            print("Running full MPI")
-        elif HAVE_MPI4PY:
-            print("MPI available, but not enough nodes for master/slave")
 
-    if HAVE_MPI4PY and not HAVE_MPI:
-        sys.exit(1) # not enough nodes to actually run master/slave... shut down MPI now.
-        
-except:
-    if DEBUG:
-        import traceback
-        traceback.print_exc()
-        if HAVE_MPI4PY and HAVE_MPI:
-            print("Running full MPI")
-        elif HAVE_MPI4PY:
-            print("MPI available, but not enough nodes for master/slave")
-        else:
-            print("No MPI.")
+if DEBUG:
+    if HAVE_MPI4PY and HAVE_MPI:
+        print("Running full MPI")
+    elif HAVE_MPI4PY:
+        print("MPI available, but not enough nodes for master/slave")
+    else:
+        print("No MPI.")
         
 if HAVE_MPI:
     class GenericMPI (MPIWork):
     
-        def __init__(self, f, l, return_=False, debug=False):
+        def __init__(self, f, l, return_=False, debug=False, resultDtype=None, resultShape=()):
             """
             Used to implement 'foreach' functionality using mpi. 
             Apply a function to each element of list l
+            If f returns numbers (or fixed shape arrays) give their resultDtype
+            (and resultShape) to collect the results in a numpy array.
             """
             self.applyFunc = f
             self.worklist = l
             self.return_ = return_
             self.debug = debug
+            self.resultDtype = resultDtype
+            self.resultShape = tuple(resultShape)
             
         def getNumWorkItems(self):
             """
@@ -78,17 +81,46 @@ if HAVE_MPI:
             Set up someplace to hold the answers...
             """
             self.count = 0
-            self.results = [None]*len(self.worklist)
+            if self.resultDtype is not None:
+                self.results = numpy.empty((len(self.worklist),) + self.resultShape, dtype=self.resultDtype)
+            else:
+                self.results = [None]*len(self.worklist)
             
     class SimpleMasterSlave(MPIWork):
         """
         Allow true master/slave processing with saved state etc.
         """
     
-        def __init__(self, masterClass, slaveClass, workParams):
+        def __init__(self, masterClass, slaveClass, workParams=None, workParamsLoader=None):
+                """
+                If workParamsLoader is given, it is called on rank 0 only to
+                produce the workParams, which are then broadcast to every rank.
+                """
                 self.masterClass = masterClass
                 self.slaveClass = slaveClass
+                if workParamsLoader is not None:
+                    workParams = self.loadWorkParams(workParamsLoader)
                 self.worklist = workParams
+
+        def loadWorkParams(self, loader):
+            """
+            Call loader on rank 0 and broadcast the result.
+            Numeric numpy arrays are broadcast as raw buffers, anything else
+            (strings, records, dates...) is pickled.
+            """
+            params = header = None
+            if MY_RANK == 0:
+                params = loader()
+                if isinstance(params, numpy.ndarray) and params.dtype.kind in '?biufc':
+                    params = numpy.ascontiguousarray(params)
+                    header = (params.shape, params.dtype.str)
+            header = comm.bcast(header, root=0)
+            if header is None:
+                return comm.bcast(params, root=0)
+            if MY_RANK != 0:
+                params = numpy.empty(header[0], numpy.dtype(header[1]))
+            comm.Bcast(params, root=0)
+            return params
                 
         def getNumWorkItems(self):
             """
@@ -109,18 +141,18 @@ if HAVE_MPI:
             """
             Set up someplace to hold the answers...
             """
-            if not hasattr(self.masterClass, '__init__'):
-                self.masterInstance = self.masterClass  # it must really be an instance
-            else:
+            if inspect.isclass(self.masterClass):
                 self.masterInstance = self.masterClass()
+            else:
+                self.masterInstance = self.masterClass  # it must really be an instance
                 
             self.results = [None]*len(self.worklist)
             
         def slaveBeforeWork(self):
-            if not hasattr(self.slaveClass, '__init__'):
+            if inspect.isclass(self.slaveClass):
+                self.slaveInstance = self.slaveClass()
+            else:
                 self.slaveInstance = self.slaveClass   # it must really be an instance
-                
-            self.slaveInstance = self.slaveClass()
 
         def getMasterInstance(self):
             """
@@ -140,14 +172,21 @@ if HAVE_MPI:
             else:
                 raise RuntimeError("Sorry.. you need to 'run' first!")
 
-def RunMasterSlave(masterClass, slaveClass, workParams, useMPI=True, finalRun=True):
+def RunMasterSlave(masterClass, slaveClass, workParams=None, useMPI=True, finalRun=True, batchSize=None,
+                   mode='dynamic', workParamsLoader=None):
     """
     This is a generic master/slave runner.
+    batchSize is the number of work items sent to a slave at a time (None == automatic).
+    mode is 'dynamic' (hand out work as slaves finish), 'static' (split it evenly up front)
+    'hierarchical' (like 'dynamic', through one sub-master per node) or 'stealing'
+    (slaves start on an even share and steal from each other when they run out).
+    Instead of workParams you can pass workParamsLoader, a function returning the
+    workParams. With MPI it is only called on rank 0 and the result is broadcast.
     """
     if HAVE_MPI and useMPI:
-        MSRunner = SimpleMasterSlave(masterClass, slaveClass, workParams)
-        balancer = MPIBalancer(MSRunner, False)
-        balancer.run(finalRun)
+        MSRunner = SimpleMasterSlave(masterClass, slaveClass, workParams, workParamsLoader)
+        balancer = MPIBalancer(MSRunner, False, batchSize)
+        balancer.run(finalRun, mode)
         if MY_RANK==0:
             return MSRunner.getMasterInstance()
         else:
@@ -156,25 +195,43 @@ def RunMasterSlave(masterClass, slaveClass, workParams, useMPI=True, finalRun=Tr
         #
         # run serially in case there's no MPI or the called doesn't want it.
         #
-        master = masterClass()
-        slave = slaveClass()
+        master = masterClass() if inspect.isclass(masterClass) else masterClass
+        slave = slaveClass() if inspect.isclass(slaveClass) else slaveClass
+        if workParamsLoader is not None:
+            workParams = workParamsLoader()
         for i in range(len(workParams)):
             master(i,slave(workParams[i]))
 
         return master
 
-def foreach(f, l, useMPI=True, return_=True, debug=False, finalRun=True):
+def foreach(f, l, useMPI=True, return_=True, debug=False, finalRun=True, batchSize=None, vectorized=False,
+            useLocalPool=False, releasesGIL=False, mode='dynamic', resultDtype=None, resultShape=()):
     """
     for each element in list 'l' apply the function 'f'.
     You can force serial operation by setting useMPI to 'False'
     The last time you're call foreach... make sure finalRun=True.
+    batchSize is the number of items sent to a slave at a time (None == automatic).
+    mode='static' splits the list evenly over the slaves up front (scatter/gather),
+    which is cheaper than the default 'dynamic' balancing when every item costs the same.
+    mode='hierarchical' balances dynamically through one sub-master per node, for runs
+    with so many slaves that rank 0 becomes the bottleneck. mode='stealing' starts each
+    slave on an even share and lets idle slaves steal from busy ones.
+    When running serially on a flat numeric list, a single output numpy ufunc 'f' (or any 'f' that
+    works on whole arrays, flagged by vectorized=True or an f.vectorized attribute)
+    is called once on the entire list instead of once per element.
+    Without MPI, useLocalPool=True spreads the work over the local cores with a
+    process pool ('f' must be picklable), or a thread pool if releasesGIL=True.
+    If 'f' returns numbers (or arrays of a fixed shape) pass resultDtype (and
+    resultShape): results then come back as a numpy array, and with MPI they are
+    sent as raw buffers instead of being pickled.
+    'f' may be compiled with numba through the jit decorator.
     """
     if HAVE_MPI and useMPI:
         if debug and MY_RANK==0:
             print("Found MPI environment with multiple nodes.. using MPI!")
-        GMPI = GenericMPI(f, l, debug=debug)
-        balancer = MPIBalancer(GMPI, False) # set this to True to get lots of debugging output
-        balancer.run(finalRun)
+        GMPI = GenericMPI(f, l, debug=debug, resultDtype=resultDtype, resultShape=resultShape)
+        balancer = MPIBalancer(GMPI, False, batchSize) # set this to True to get lots of debugging output
+        balancer.run(finalRun, mode)
         if return_:
             if MY_RANK==0:
                 return GMPI.results
@@ -187,6 +244,40 @@ def foreach(f, l, useMPI=True, return_=True, debug=False, finalRun=True):
         if debug:
             print("No MPI environment with multiple nodes.. evaluating serially.")
 
+        if vectorized or (isinstance(f, numpy.ufunc) and f.nout == 1) or getattr(f, 'vectorized', False):
+            try:
+                arr = numpy.asarray(l)
+            except ValueError:
+                arr = None  # ragged list: go item by item
+            if arr is not None and arr.ndim == 1 and arr.dtype.kind in 'biufc':
+                if debug:
+                    print("Applying vectorized function to all", len(arr), "items.")
+                results = f(arr)
+                if return_:
+                    if isinstance(results, tuple):
+                        # several outputs: one tuple per item, like the per-item path
+                        return list(zip(*(r.tolist() for r in results)))
+                    if resultDtype is not None:
+                        return numpy.asarray(results, dtype=resultDtype)
+                    return numpy.asarray(results).tolist()
+                return
+
+        if useLocalPool:
+            workers = os.cpu_count() or 1
+            if releasesGIL or isinstance(f, numpy.ufunc):
+                Executor = ThreadPoolExecutor
+            else:
+                Executor = ProcessPoolExecutor
+            if debug:
+                print("Using a local pool of", workers, "workers.")
+            with Executor(max_workers=workers) as ex:
+                results = list(ex.map(f, l, chunksize=max(1, len(l)//(workers*4))))
+            if return_:
+                if resultDtype is not None:
+                    return numpy.array(results, dtype=resultDtype)
+                return results
+            return
+
         if return_:
             results=[]
             for v in l:
@@ -194,6 +285,8 @@ def foreach(f, l, useMPI=True, return_=True, debug=False, finalRun=True):
                 if debug:
                     print("Work item completed:", len(results), ':', result)
                 results.append(result)
+            if resultDtype is not None:
+                return numpy.array(results, dtype=resultDtype)
             return results
         else:
             for v in l:
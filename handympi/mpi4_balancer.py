@@ -3,6 +3,8 @@
 Simple load balancing with mpi4py, ported from pypar by Felix Richter <felix.richter2@uni-rostock.de>
 June 4, 2019, Steve Spicklemire
 """
+import logging
+import random
 import sys
 import time
 
@@ -11,21 +13,37 @@ from mpi4py import MPI
 
 MPI_WORKTAG = 1
 MPI_DIETAG = 2
+MPI_BIGTAG = 3
+MPI_STEALTAG = 4
+MPI_LOOTTAG = 5
+
+MPI_RECV_BUFSIZE = 1 << 16  # results bigger than this are announced, then sent separately
+
+log = logging.getLogger(__name__)
+
+MY_RANK = MPI.COMM_WORLD.Get_rank()
 
 def mprint(txt):
     """
     Print message txt
     with indentation following the node's rank
     """
-    myRank = MPI.COMM_WORLD.Get_rank()
-    pre = " " * 8 * myRank
-    if type(txt) != type('dummy'):
-        txt = txt.__str__()
+    pre = " " * 8 * MY_RANK
+    if not isinstance(txt, str):
+        txt = str(txt)
     pat = "-%d-"
-    print (pre + (pat % myRank) + txt)
+    print (pre + (pat % MY_RANK) + txt)
 
 class MPIWork(object):
-    """Abstract base class for ant work to be balanced"""
+    """Abstract base class for ant work to be balanced
+
+    calcWorkResult returns a (worknum, value) pair. If every value is numeric
+    set resultDtype (and resultShape for array values) so results travel as
+    raw numpy buffers instead of being pickled.
+    """
+    
+    resultDtype = None
+    resultShape = ()
 
     def __init__(self):
         pass
@@ -63,8 +81,8 @@ class MPIWork(object):
     
     def msgprint(self, txt):
         pre = " " * 8 * self.mpi_id
-        if type(txt) != type('dummy'):
-            txt = txt.__str__()
+        if not isinstance(txt, str):
+            txt = str(txt)
         pat = "-%d-"
         print(pre + (pat % self.mpi_id) + txt)
         
@@ -74,10 +92,18 @@ class MPIBalancer(object):
     Initialize it with a MPIWork-derived class instance
     which describes the actual work to do.
     
-    debug == True - more status messages
+    debug == True - more status messages (through the logger of this module)
+    batchSize - how many work items to hand a slave per message
+                (None == pick one based on the number of works and slaves)
+    bootstrap == True - only the master needs to build the work, it is
+                broadcast to the slaves (which may pass work=None)
+    stealThreshold - (work stealing) a slave gives work away only when it has
+                at least this many items left
+    maxStealBatch - (work stealing) most items given away per steal (None == half)
     """
     
-    def __init__(self, work, debug = False):
+    def __init__(self, work, debug = False, batchSize = None, bootstrap = False,
+                 stealThreshold = 2, maxStealBatch = None):
         self.comm = MPI.COMM_WORLD
         self.numprocs = self.comm.Get_size()  # Number of processes as specified by mpirun
         self.myid = self.comm.Get_rank()      # Id of of this process (myid in [0, numproc-1]) 
@@ -91,91 +117,590 @@ class MPIBalancer(object):
             msg += ' for the Master Slave paradigm to make sense.'
             raise Exception(msg)
 
+        if bootstrap:
+            self.bootstrap()
         
         self.work.uplink(self, self.myid, self.numprocs, self.node)
         
         self.numworks = self.work.getNumWorkItems()
-        if self.debug:
-            print("MPIBalancer initialised on proc %d of %d on node %s" %(self.myid, self.numprocs, self.node))
+        if batchSize is None:
+            batchSize = max(1, self.numworks // (8*(self.numprocs-1)))
+        elif batchSize < 1:
+            raise ValueError('batchSize must be at least 1, got %r' % (batchSize,))
+        self.batchSize = batchSize
+        self.stealThreshold = stealThreshold
+        self.maxStealBatch = maxStealBatch
+        
+        self.resultBufs = None   # master: one receive buffer per slave
+        self.resultBuf = None    # slave: send buffer
+        self.workBufs = None     # master: one send buffer per slave
+        self.recvBufs = {}       # master: pickled result buffers by (comm handle, slave)
+        # works that don't derive from MPIWork need not say anything about their results
+        self.resultDtype = getattr(self.work, 'resultDtype', None)
+        self.resultShape = tuple(getattr(self.work, 'resultShape', ()))
+        if self.resultDtype is not None:
+            shape = (self.batchSize,) + self.resultShape
+            if self.myid == 0:
+                self.resultBufs = [numpy.empty(shape, self.resultDtype) for i in range(1, self.numprocs)]
+                # work goes out as a (start, stop) pair, one buffer per slave
+                self.workBufs = [numpy.zeros(2, numpy.int64) for i in range(1, self.numprocs)]
+            else:
+                self.resultBuf = numpy.empty(shape, self.resultDtype)
+        if debug:
+            log.setLevel(logging.DEBUG)
+            if not log.handlers:
+                log.addHandler(logging.StreamHandler(sys.stdout))
+        log.disabled = not debug
+        log.debug("MPIBalancer initialised on proc %d of %d on node %s", self.myid, self.numprocs, self.node)
+
+    def bootstrap(self):
+        """
+        Broadcast the master's work instance to all the slaves, which then keep
+        their own copy resident. Uses cloudpickle, when installed, so works
+        holding lambdas or closures can be sent too.
+        """
+        data = None
+        if self.myid == 0:
+            try:
+                import cloudpickle
+                data = cloudpickle.dumps(self.work)
+            except ImportError:
+                data = MPI.pickle.dumps(self.work)
+        data = self.comm.bcast(data, root=0)
+        if self.myid != 0:
+            self.work = MPI.pickle.loads(data)
+
+    def nextBatch(self, start, stop=None, width=1, workers=None):
+        """
+        Return the range of work items to send out next, beginning at 'start'
+        (and ending before 'stop', default: the end of the worklist).
+        Batches shrink near the end of the worklist so the slaves finish together.
+        A sub-master standing in for 'width' slaves gets 'width' times as much,
+        'workers' is the number of slaves sharing the work.
+        """
+        if stop is None:
+            stop = self.numworks
+        if workers is None:
+            workers = self.numprocs - 1
+        remaining = stop - start
+        size = min(self.batchSize * width, max(1, remaining * width // (2*workers)), remaining)
+        return range(start, start + size)
+
+    def postResultRecv(self, slave, comm=None):
+        """
+        Post a receive for the next batch of results from 'slave'
+        (on 'comm', which is always pickled, default: the balancer's own)
+        """
+        if comm is None:
+            if self.resultBufs is not None:
+                return self.comm.Irecv(self.resultBufs[slave-1], source=slave, tag=MPI_WORKTAG)
+            comm = self.comm
+        # only one receive per slave is ever outstanding, so its buffer is reused
+        key = (comm.py2f(), slave)
+        buf = self.recvBufs.get(key)
+        if buf is None:
+            buf = self.recvBufs[key] = bytearray(MPI_RECV_BUFSIZE)
+        return comm.irecv(buf, source=slave, tag=MPI.ANY_TAG)
+
+    def sendResults(self, comm, results):
+        """
+        Send a list of results to rank 0 of 'comm', announcing it first
+        if it is too big for the receive buffer posted there
+        """
+        data = MPI.pickle.dumps(results)
+        if len(data) > MPI_RECV_BUFSIZE:
+            comm.send(len(data), dest=0, tag=MPI_BIGTAG)
+        comm.Send([data, MPI.BYTE], dest=0, tag=MPI_WORKTAG)
+
+    def postWorkSend(self, slave, work):
+        """
+        Start sending the range of work items 'work' to 'slave'
+        """
+        if self.workBufs is not None:
+            buf = self.workBufs[slave-1]
+            buf[0] = work.start
+            buf[1] = work.stop
+            return self.comm.Isend(buf, dest=slave, tag=MPI_WORKTAG)
+        return self.comm.isend(work, dest=slave, tag=MPI_WORKTAG)
+
+    def terminate(self, comm):
+        """
+        Tell the slaves on 'comm' to stop working, with a single broadcast
+        (they wait for it next to their work, see postTermination)
+        """
+        comm.Ibcast(numpy.ones(1, numpy.int8), root=0).Wait()
+
+    def postTermination(self, comm):
+        """
+        Join the broadcast by which rank 0 of 'comm' ends the work loop
+        """
+        return comm.Ibcast(numpy.zeros(1, numpy.int8), root=0)
 
     def master(self):
-        if self.debug: print('[MASTER %d]: I am processor %d of %d on node %s' % (self.myid, self.myid, self.numprocs, self.node))
-        if self.debug: print('[MASTER %d]: About to distribute work', min(self.numprocs-1, self.numworks))
+        log.debug('[MASTER %d]: I am processor %d of %d on node %s', self.myid, self.myid, self.numprocs, self.node)
+        log.debug('[MASTER %d]: About to distribute work in batches of up to %d', self.myid, self.batchSize)
 
-        numcompleted = 0
-        #--- start slaves distributing the first work slot
-        for i in range(0, min(self.numprocs-1, self.numworks)): 
-            work = i
-            slave= i+1
-            self.comm.send(work, dest=slave, tag=MPI_WORKTAG) 
-            if self.debug: print('[MASTER ]: sent first work "%s" to node %d' %(work, slave))
+        nextwork = 0      # first work item not yet sent out
+        outstanding = 0   # batches sent out, but not yet returned
+        
+        # one pending receive and send per slave, slave rank == list index + 1
+        recvReqs = [MPI.REQUEST_NULL] * (self.numprocs-1)
+        sendReqs = [MPI.REQUEST_NULL] * (self.numprocs-1)
+        batches = [None] * (self.numprocs-1)
+        
+        #--- start slaves distributing the first work batch
+        #    (all sends posted at once, each is waited for before that slave's next one)
+        for slave in range(1, self.numprocs):
+            if nextwork >= self.numworks:
+                break
+            work = self.nextBatch(nextwork)
+            nextwork = work.stop
+            batches[slave-1] = work
+            recvReqs[slave-1] = self.postResultRecv(slave)
+            sendReqs[slave-1] = self.postWorkSend(slave, work)
+            outstanding += 1
+            log.debug('[MASTER ]: sent first work "%s" to node %d', work, slave)
     
-        if self.debug: print('[MASTER ]: Finished sending work')
+        log.debug('[MASTER ]: Finished sending work')
         
-        # dispatch the remaining work slots on dynamic load-balancing policy
+        # dispatch the remaining work batches on dynamic load-balancing policy
         # the quicker to do the job, the more jobs it takes
-        for work in range(self.numprocs-1, self.numworks):
-            if self.debug: print('[MASTER ]: check for finished work')
-            result = self.comm.recv(source=MPI.ANY_SOURCE, tag=MPI_WORKTAG, status=self.status)
-            if self.debug: print('[MASTER ]: received result from node %d' %(self.status.source,))
-
-            numcompleted += 1
-            self.comm.send(work, dest=self.status.source, tag=MPI_WORKTAG)
-            if self.debug: print('[MASTER ]: sent work "%s" to node %d' %(work, self.status.source))
+        # hot loop: bind everything it touches to locals
+        comm = self.comm
+        status = self.status
+        debug = log.isEnabledFor(logging.DEBUG)
+        numworks = self.numworks
+        resultBufs = self.resultBufs
+        nextBatch = self.nextBatch
+        postResultRecv = self.postResultRecv
+        postWorkSend = self.postWorkSend
+        handle = self.work.handleWorkResult
+        waitany = MPI.Request.waitany
+        Waitany = MPI.Request.Waitany
+        WORK = MPI_WORKTAG
+        BIG = MPI_BIGTAG
+        REQUEST_NULL = MPI.REQUEST_NULL
+        while outstanding:
+            if resultBufs is not None:
+                index = Waitany(recvReqs, status)
+                batch = batches[index]
+                # copy, the buffer is reused by the next receive from this slave
+                results = list(zip(batch, resultBufs[index][:len(batch)].copy()))
+            else:
+                index, results = waitany(recvReqs, status)
+                if status.tag == BIG:
+                    # too big for the posted buffer, the slave sends it along next
+                    results = comm.recv(source=index+1, tag=WORK)
+            slave = index + 1
+
+            outstanding -= 1
+            if nextwork < numworks:
+                work = nextBatch(nextwork)
+                nextwork = work.stop
+                batches[index] = work
+                recvReqs[index] = postResultRecv(slave)
+                sendReqs[index].wait()
+                sendReqs[index] = postWorkSend(slave, work)
+                outstanding += 1
+            else:
+                work = None
+                recvReqs[index] = REQUEST_NULL
             
-            self.work.handleWorkResult(result, self.status)
-        
-        # all works have been dispatched out
-        if self.debug: print ('[MASTER ]: ToDo : %d' %self.numworks)
-        if self.debug: print ('[MASTER ]: Done : %d' %numcompleted)
-        
-        # I've still to take into the remaining completions   
-        while (numcompleted < self.numworks): 
-            if self.debug: print ('[MASTER ]: waiting for results')
-            result = self.comm.recv(source=MPI.ANY_SOURCE, tag=MPI_WORKTAG, status=self.status) 
-            if self.debug: print ('[MASTER ]: received (final) result from node %d' % (self.status.source, ))
-            numcompleted += 1
-            if self.debug: print ('[MASTER ]: %d completed' % numcompleted)
+            if debug:
+                log.debug('[MASTER ]: received %d results from node %d', len(results), slave)
+                if work is not None:
+                    log.debug('[MASTER ]: sent work "%s" to node %d', work, slave)
             
-            self.work.handleWorkResult(result, self.status)
+            for result in results:
+                handle(result, status)
             
-        if self.debug: print ('[MASTER ]: about to terminate slaves')
+        MPI.Request.waitall(sendReqs)
+        log.debug('[MASTER ]: about to terminate slaves')
     
         # Tell slaves to stop working
-        for i in range(1, self.numprocs): 
-            self.comm.send('#', dest=i, tag=MPI_DIETAG) 
-            if self.debug: print ('[MASTER ]: sent DIETAG to node %d' %(i,))
+        self.terminate(self.comm)
+        log.debug('[MASTER ]: terminated %d nodes', self.numprocs-1)
 
-    def slave(self):
-        if self.debug: print('[SLAVE %d]: I am processor %d of %d on node %s' % (self.myid, self.myid, self.numprocs, self.node))
-        if self.debug: print('[SLAVE %d]: Entering work loop' % (self.myid,))
+    def slave(self, comm=None):
+        """
+        Work loop of a slave, taking work from rank 0 of 'comm'
+        (default: the balancer's own, with numeric results sent as raw buffers)
+        """
+        log.debug('[SLAVE %d]: I am processor %d of %d on node %s', self.myid, self.myid, self.numprocs, self.node)
+        log.debug('[SLAVE %d]: Entering work loop', self.myid)
+        if comm is None:
+            if self.resultBuf is not None:
+                return self.bufferSlave()
+            comm = self.comm
+        
+        dieReq = self.postTermination(comm)
+        
+        irecv = comm.irecv
+        waitany = MPI.Request.waitany
+        debug = log.isEnabledFor(logging.DEBUG)
+        myid = self.myid
+        calc = self.work.calcWorkResult
+        sendResults = self.sendResults
+        WORK = MPI_WORKTAG
         while True:
-            result = self.comm.recv(source=0, tag=MPI.ANY_TAG, status=self.status)
-            if self.debug: print('[SLAVE %d]: received work'\
-                      %(self.myid,))
+            workReq = irecv(source=0, tag=WORK)
+            index, work = waitany([workReq, dieReq])
            
-            if (self.status.tag == MPI_DIETAG):
-                if self.debug: print('[SLAVE %d]: received termination from node %d' % (self.myid, 0))
+            if index == 1:
+                workReq.Cancel()
+                workReq.Wait()
+                log.debug('[SLAVE %d]: received termination from node %d', myid, 0)
                 return
             else:
-                worknum = result
-                if self.debug: print('[SLAVE %d]: work number is %s' % (self.myid, worknum))
-                myresult = self.work.calcWorkResult(worknum)
-                self.comm.send(myresult, dest=0, tag=MPI_WORKTAG)
-                if self.debug: print('[SLAVE %d]: sent result %s to node %d' % (self.myid, str(myresult), 0))
+                sendResults(comm, [calc(worknum) for worknum in work])
+                if debug: log.debug('[SLAVE %d]: sent results for work numbers %s to node %d', myid, work, 0)
+
+    def bufferSlave(self):
+        """
+        Slave work loop for numeric results (resultDtype set). Work arrives as a
+        (start, stop) pair and results leave in a fixed size buffer, so both
+        messages are set up once as persistent requests and just restarted.
+        """
+        workBuf = numpy.zeros(2, numpy.int64)
+        buf = self.resultBuf
+        rreq = self.comm.Recv_init(workBuf, source=0, tag=MPI_WORKTAG)
+        sreq = self.comm.Send_init(buf, dest=0, tag=MPI_WORKTAG)
+        dieReq = self.postTermination(self.comm)
+        
+        Waitany = MPI.Request.Waitany
+        debug = log.isEnabledFor(logging.DEBUG)
+        myid = self.myid
+        calc = self.work.calcWorkResult
+        try:
+            while True:
+                rreq.Start()
+                if Waitany([rreq, dieReq]) == 1:
+                    rreq.Cancel()
+                    rreq.Wait()
+                    log.debug('[SLAVE %d]: received termination from node %d', myid, 0)
+                    return
+                work = range(int(workBuf[0]), int(workBuf[1]))
+                for i, worknum in enumerate(work):
+                    buf[i] = calc(worknum)[1]
+                sreq.Start()
+                sreq.Wait()
+                if debug: log.debug('[SLAVE %d]: sent results for work numbers %s to node %d', myid, work, 0)
+        finally:
+            rreq.Free()
+            sreq.Free()
+
+    def staticChunks(self):
+        """
+        Split the work items into one contiguous range per slave
+        (the master, rank 0, gets an empty range)
+        """
+        nslaves = self.numprocs - 1
+        bounds = [self.numworks * i // nslaves for i in range(nslaves + 1)]
+        return [range(0, 0)] + [range(bounds[i], bounds[i+1]) for i in range(nslaves)]
+
+    def staticMaster(self):
+        log.debug('[MASTER %d]: scattering %d works over %d slaves', self.myid, self.numworks, self.numprocs-1)
+        chunks = self.staticChunks()
+        self.comm.scatter(chunks, root=0)
+        
+        if self.resultDtype is not None:
+            shape = self.resultShape
+            counts = [len(chunk) * int(numpy.prod(shape)) for chunk in chunks]
+            values = numpy.empty((self.numworks,) + shape, self.resultDtype)
+            self.comm.Gatherv(values[:0], [values, counts], root=0)
+            results = zip(range(self.numworks), values)
+        else:
+            results = [result for chunk in self.comm.gather(None, root=0)[1:] for result in chunk]
+        log.debug('[MASTER ]: gathered all results')
+        
+        for result in results:
+            self.work.handleWorkResult(result, self.status)
+
+    def staticSlave(self):
+        work = self.comm.scatter(None, root=0)
+        log.debug('[SLAVE %d]: work numbers are %s', self.myid, work)
+        if self.resultDtype is not None:
+            values = numpy.empty((len(work),) + self.resultShape, self.resultDtype)
+            for i, worknum in enumerate(work):
+                values[i] = self.work.calcWorkResult(worknum)[1]
+            self.comm.Gatherv(values, None, root=0)
+        else:
+            self.comm.gather([self.work.calcWorkResult(worknum) for worknum in work], root=0)
+        log.debug('[SLAVE %d]: sent %d results to node %d', self.myid, len(work), 0)
+
+    def splitNodes(self):
+        """
+        Return a communicator for each group of ranks sharing a node
+        """
+        return self.comm.Split_type(MPI.COMM_TYPE_SHARED, key=self.myid)
+
+    def serve(self, clients, work, handle):
+        """
+        Hand out the range of work items 'work' in batches to 'clients', and
+        pass every result that comes back to 'handle'.
+        clients is a list of (comm, rank, width, hello) where a sub-master
+        stands in for 'width' slaves and says hello (an empty result list)
+        before it gets its first batch. Messages are always pickled.
+        """
+        workers = sum(client[2] for client in clients)
+        nextwork = work.start
+        outstanding = 0
+        recvReqs = [MPI.REQUEST_NULL] * len(clients)
+        sendReqs = [MPI.REQUEST_NULL] * len(clients)
+        
+        for index, (comm, rank, width, hello) in enumerate(clients):
+            if hello:
+                recvReqs[index] = self.postResultRecv(rank, comm)
+                outstanding += 1
+            elif nextwork < work.stop:
+                batch = self.nextBatch(nextwork, work.stop, width, workers)
+                nextwork = batch.stop
+                recvReqs[index] = self.postResultRecv(rank, comm)
+                sendReqs[index] = comm.isend(batch, dest=rank, tag=MPI_WORKTAG)
+                outstanding += 1
+        
+        status = self.status
+        debug = log.isEnabledFor(logging.DEBUG)
+        while outstanding:
+            index, results = MPI.Request.waitany(recvReqs, status)
+            comm, rank, width, hello = clients[index]
+            if status.tag == MPI_BIGTAG:
+                results = comm.recv(source=rank, tag=MPI_WORKTAG)
+            
+            outstanding -= 1
+            if nextwork < work.stop:
+                batch = self.nextBatch(nextwork, work.stop, width, workers)
+                nextwork = batch.stop
+                recvReqs[index] = self.postResultRecv(rank, comm)
+                sendReqs[index].wait()
+                sendReqs[index] = comm.isend(batch, dest=rank, tag=MPI_WORKTAG)
+                outstanding += 1
+            else:
+                batch = None
+                recvReqs[index] = MPI.REQUEST_NULL
+            
+            if debug:
+                log.debug('[SERVE %d]: received %d results from rank %d, sent it "%s"', self.myid, len(results), rank, batch)
+            for result in results:
+                handle(result, status)
+        
+        MPI.Request.waitall(sendReqs)
+
+    def hierarchicalMaster(self):
+        nodeComm = self.splitNodes()
+        leaderComm = self.comm.Split(0, self.myid)
+        # slaves behind each sub-master, a sub-master without slaves does the work itself
+        widths = leaderComm.gather(max(1, nodeComm.Get_size() - 1), root=0)
+        log.debug('[MASTER %d]: %d local slaves, %d sub-masters', self.myid, nodeComm.Get_size() - 1, leaderComm.Get_size() - 1)
+        
+        clients = [(nodeComm, rank, 1, False) for rank in range(1, nodeComm.Get_size())]
+        clients += [(leaderComm, rank, widths[rank], True) for rank in range(1, leaderComm.Get_size())]
+        self.serve(clients, range(0, self.numworks), self.work.handleWorkResult)
+        
+        log.debug('[MASTER ]: about to terminate slaves and sub-masters')
+        self.terminate(nodeComm)
+        MPI.Request.waitall([leaderComm.isend('#', dest=rank, tag=MPI_DIETAG) for rank in range(1, leaderComm.Get_size())])
+        nodeComm.Free()
+        leaderComm.Free()
+
+    def hierarchicalSlave(self):
+        nodeComm = self.splitNodes()
+        isLeader = nodeComm.Get_rank() == 0
+        leaderComm = self.comm.Split(0 if isLeader else MPI.UNDEFINED, self.myid)
+        if isLeader:
+            leaderComm.gather(max(1, nodeComm.Get_size() - 1), root=0)
+            self.subMaster(nodeComm, leaderComm)
+            leaderComm.Free()
+        else:
+            self.slave(nodeComm)
+        nodeComm.Free()
+
+    def subMaster(self, nodeComm, leaderComm):
+        """
+        Fetch chunks of work from the master and spread them over the slaves
+        on this node, handing the results back with each request for more.
+        """
+        log.debug('[SUBMASTER %d]: serving %d local slaves', self.myid, nodeComm.Get_size() - 1)
+        clients = [(nodeComm, rank, 1, False) for rank in range(1, nodeComm.Get_size())]
+        calc = self.work.calcWorkResult
+        results = []
+        while True:
+            self.sendResults(leaderComm, results)
+            chunk = leaderComm.recv(source=0, tag=MPI.ANY_TAG, status=self.status)
+            if self.status.tag == MPI_DIETAG:
+                break
+            if clients:
+                results = []
+                self.serve(clients, chunk, lambda result, status: results.append(result))
+            else:
+                results = [calc(worknum) for worknum in chunk]
+        
+        log.debug('[SUBMASTER %d]: received termination, stopping local slaves', self.myid)
+        self.terminate(nodeComm)
 
-    def run(self, finalRun=True):
+    def stealingMaster(self):
+        comm = self.comm
+        log.debug('[MASTER %d]: collecting results of %d works from work-stealing slaves', self.myid, self.numworks)
+        received = 0
+        while received < self.numworks:
+            results = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=self.status)
+            if self.status.tag == MPI_BIGTAG:
+                results = comm.recv(source=self.status.source, tag=MPI_WORKTAG)
+            received += len(results)
+            for result in results:
+                self.work.handleWorkResult(result, self.status)
+        
+        log.debug('[MASTER ]: all results in, about to terminate slaves')
+        MPI.Request.waitall([comm.isend(None, dest=rank, tag=MPI_DIETAG) for rank in range(1, self.numprocs)])
+        comm.Ibarrier().Wait()
+
+    def stealingSlave(self):
+        """
+        Work through this slave's static share of the work, sending results to
+        the master as we go. Between work items answer steal requests by giving
+        away the top half of what's left. Once out of work, steal from the other
+        slaves, asked in random order.
+        """
+        comm = self.comm
+        work = self.staticChunks()[self.myid]
+        lo, hi = work.start, work.stop
+        others = [rank for rank in range(1, self.numprocs) if rank != self.myid]
+        status = MPI.Status()
+        calc = self.work.calcWorkResult
+        waitany = MPI.Request.waitany
+        replies = []   # sends still in flight, waited for at the very end
+        stealReq = comm.irecv(source=MPI.ANY_SOURCE, tag=MPI_STEALTAG)
+        dieReq = comm.irecv(source=0, tag=MPI_DIETAG)
+        
+        def answerSteal(thief):
+            nonlocal hi, stealReq
+            give = 0
+            if hi - lo >= self.stealThreshold:
+                give = (hi - lo) // 2
+                if self.maxStealBatch is not None:
+                    give = min(give, self.maxStealBatch)
+            replies.append(comm.isend(range(hi - give, hi), dest=thief, tag=MPI_LOOTTAG))
+            hi -= give
+            stealReq = comm.irecv(source=MPI.ANY_SOURCE, tag=MPI_STEALTAG)
+            log.debug('[SLAVE %d]: gave %d works to node %d', self.myid, give, thief)
+        
+        while True:
+            if lo < hi:
+                results = []
+                while lo < hi and len(results) < self.batchSize:
+                    results.append(calc(lo))
+                    lo += 1
+                    if stealReq.test(status)[0]:
+                        answerSteal(status.source)
+                self.sendResults(comm, results)
+                continue
+            
+            loot = range(0, 0)
+            for victim in random.sample(others, len(others)):
+                replies.append(comm.isend(None, dest=victim, tag=MPI_STEALTAG))
+                lootReq = comm.irecv(source=victim, tag=MPI_LOOTTAG)
+                while True:
+                    index, msg = waitany([lootReq, stealReq], status)
+                    if index == 0:
+                        loot = msg
+                        break
+                    answerSteal(status.source)
+                if loot:
+                    break
+            if loot:
+                log.debug('[SLAVE %d]: stole works %s', self.myid, loot)
+                lo, hi = loot.start, loot.stop
+                continue
+            
+            # nobody had any to spare, wait to be told we're done
+            while True:
+                index, msg = waitany([stealReq, dieReq], status)
+                if index == 1:
+                    break
+                answerSteal(status.source)
+            break
+        
+        # keep answering (empty handed) until every slave is done asking
+        log.debug('[SLAVE %d]: received termination from node %d', self.myid, 0)
+        barrier = comm.Ibarrier()
+        while waitany([barrier, stealReq], status)[0] == 1:
+            answerSteal(status.source)
+        stealReq.Cancel()
+        stealReq.Wait()
+        MPI.Request.waitall(replies)
+
+    def run(self, finalRun=True, mode='dynamic'):
+        """
+        mode == 'dynamic'      - hand out batches of work as the slaves finish (the default)
+        mode == 'static'       - give every slave its share of the work up front
+        mode == 'hierarchical' - like 'dynamic', but the master only talks to the slaves
+                                 on its own node and to one sub-master on every other node
+        mode == 'stealing'     - every slave starts on its static share and then steals
+                                 from the others, the master only collects results
+        """
+        modes = {
+            'dynamic': (self.master, self.slave),
+            'static': (self.staticMaster, self.staticSlave),
+            'hierarchical': (self.hierarchicalMaster, self.hierarchicalSlave),
+            'stealing': (self.stealingMaster, self.stealingSlave),
+            }
+        if mode not in modes:
+            raise ValueError("Unknown balancing mode: %s" % (mode,))
+        master, slave = modes[mode]
+        
+        # every run talks on a communicator of its own, so nothing a run leaves
+        # pending (like the receive a slave cancels on termination) can catch
+        # messages meant for the next one
+        world = self.comm
         if self.myid == 0:
             self.work.masterBeforeWork()
-            self.master()
+            self.comm = world.Dup()
+            try:
+                master()
+            finally:
+                self.comm.Free()
+                self.comm = world
             self.work.masterAfterWork()
         else:
             self.work.slaveBeforeWork()
-            self.slave()
+            self.comm = world.Dup()
+            try:
+                slave()
+            finally:
+                self.comm.Free()
+                self.comm = world
             self.work.slaveAfterWork()
 
+    def runStatic(self, finalRun=True):
+        """
+        Scatter the work evenly over the slaves and gather the results.
+        Cheaper than the dynamic balancing when all work items cost about the same.
+        """
+        self.run(finalRun, 'static')
+
+    def runHierarchical(self, finalRun=True):
+        """
+        Balance the work over one sub-master per node, which balances it over
+        the slaves of that node. Keeps rank 0 from drowning in messages when
+        there are many slaves.
+        """
+        self.run(finalRun, 'hierarchical')
+
+    def runStealing(self, finalRun=True):
+        """
+        Start every slave on an even share of the work and let idle slaves steal
+        from busy ones. Nobody schedules centrally, the master only collects results.
+        """
+        self.run(finalRun, 'stealing')
+
+def _kernel(worknum, worklist):
+    return worklist[worknum] + 1
+
 class MPIDemoWork(MPIWork):
     """Example PyparWork implementation"""
+    
+    resultDtype = numpy.float64
+    
     def __init__(self):
         import numpy
         self.worklist = numpy.arange(0.0,20.0)
@@ -185,7 +710,7 @@ class MPIDemoWork(MPIWork):
         return len(self.worklist)
     
     def calcWorkResult(self, worknum):
-        return [worknum, self.worklist[worknum] + 1]
+        return [worknum, _kernel(worknum, self.worklist)]
 
     def handleWorkResult(self, result, status):
         self.resultlist[result[0]] = result[1]
@@ -207,6 +732,12 @@ if __name__ == "__main__":
     print("::: PyParBalancer TEST ")
     print("-----------------------")
     
+    if __package__:
+        from .accel import jit
+    else:
+        from accel import jit  # run as a script, accel sits right next to this file
+    _kernel = jit(_kernel)
+    
     # create instance of work class
     mpiwork = MPIDemoWork()
 
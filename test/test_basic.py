@@ -1,4 +1,21 @@
-from handympi import foreach, MY_RANK
+import numpy
+
+from handympi import foreach, RunMasterSlave, MY_RANK
+
+class Collector:
+
+    def __init__(self):
+        self.results = {}
+
+    def __call__(self, i, result):
+        self.results[i] = result
+
+
+class Squarer:
+
+    def __call__(self, x):
+        return x*x
+
 
 class BasicTests:
 
@@ -9,3 +26,115 @@ class BasicTests:
 
         assert x == y
 
+
+class TestSerial:
+
+    def test_foreach_vectorized(self):
+
+        x = foreach(lambda x: x**3, list(range(40)), useMPI=False, vectorized=True)
+        y = list(map(lambda x: x**3, range(40)))
+
+        assert x == y
+
+    def test_foreach_ufunc(self):
+
+        x = foreach(numpy.sqrt, [1.0, 4.0, 9.0], useMPI=False)
+
+        assert x == [1.0, 2.0, 3.0]
+
+    def test_foreach_multi_output_ufunc(self):
+
+        x = foreach(numpy.modf, [1.5, 2.25], useMPI=False)
+        assert [tuple(map(float, r)) for r in x] == [(0.5, 1.0), (0.25, 2.0)]
+
+        x = foreach(numpy.frexp, [1.0, 8.0], useMPI=False)
+        assert [(float(m), int(e)) for m, e in x] == [(0.5, 1), (0.5, 4)]
+        assert all(isinstance(e, (int, numpy.integer)) for m, e in x)
+
+    def test_foreach_ufunc_nested(self):
+
+        x = foreach(numpy.sqrt, [[1.0, 4.0], [9.0]], useMPI=False)
+        assert [r.tolist() for r in x] == [[1.0, 2.0], [3.0]]
+
+        x = foreach(numpy.sqrt, [[1.0, 4.0], [9.0, 16.0]], useMPI=False)
+        assert all(isinstance(r, numpy.ndarray) for r in x)
+        assert [r.tolist() for r in x] == [[1.0, 2.0], [3.0, 4.0]]
+
+    def test_foreach_vectorized_multi_output(self):
+
+        f = lambda a: (a + 1, a * 2)
+        x = foreach(f, [1, 2, 3], useMPI=False, vectorized=True)
+
+        assert x == [(2, 2), (3, 4), (4, 6)]
+
+    def test_foreach_local_pool(self):
+
+        x = foreach(abs, list(range(-20, 20)), useMPI=False, useLocalPool=True)
+        y = list(map(abs, range(-20, 20)))
+
+        assert x == y
+
+    def test_foreach_local_thread_pool(self):
+
+        x = foreach(abs, list(range(-20, 20)), useMPI=False, useLocalPool=True, releasesGIL=True)
+        y = list(map(abs, range(-20, 20)))
+
+        assert x == y
+
+    def test_run_master_slave_instances(self):
+
+        master = Collector()
+        x = RunMasterSlave(master, Squarer(), [1, 2, 3], useMPI=False)
+
+        assert x is master
+        assert master.results == {0: 1, 1: 4, 2: 9}
+
+    def test_run_master_slave_classes(self):
+
+        x = RunMasterSlave(Collector, Squarer, [1, 2, 3], useMPI=False)
+
+        assert isinstance(x, Collector)
+        assert x.results == {0: 1, 1: 4, 2: 9}
+
+    def test_run_master_slave_loader(self):
+
+        calls = []
+        def loader():
+            calls.append(1)
+            return [4, 5]
+
+        x = RunMasterSlave(Collector, Squarer, workParamsLoader=loader, useMPI=False)
+
+        assert calls == [1]
+        assert x.results == {0: 16, 1: 25}
+
+    def test_foreach_result_dtype(self):
+
+        x = foreach(lambda x: x*0.5, list(range(6)), useMPI=False, resultDtype=numpy.float64)
+
+        assert isinstance(x, numpy.ndarray)
+        assert x.dtype == numpy.float64
+        assert x.tolist() == [0.0, 0.5, 1.0, 1.5, 2.0, 2.5]
+
+    def test_foreach_result_shape(self):
+
+        x = foreach(lambda x: [x, -x], [1, 2], useMPI=False, resultDtype=numpy.int64, resultShape=(2,))
+
+        assert x.shape == (2, 2)
+        assert x.tolist() == [[1, -1], [2, -2]]
+
+    def test_jit(self, monkeypatch):
+
+        import sys, types
+        from handympi import jit
+
+        def cube(x):
+            return x**3
+
+        monkeypatch.setitem(sys.modules, 'numba', None)
+        assert jit(cube) is cube
+
+        numba = types.ModuleType('numba')
+        numba.njit = lambda **kw: lambda f: ('compiled', f, kw)
+        monkeypatch.setitem(sys.modules, 'numba', numba)
+        assert jit(cube) == ('compiled', cube, {'cache': True, 'fastmath': True})
@@ -0,0 +1,113 @@
+import os
+import shutil
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+pytest.importorskip('mpi4py')
+
+MPIRUN = shutil.which('mpirun') or shutil.which('mpiexec')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+pytestmark = pytest.mark.skipif(MPIRUN is None, reason='mpirun not available')
+
+def mpirun(tmp_path, script, nprocs=3):
+    """
+    Run 'script' on nprocs ranks and return what rank 0 printed.
+    """
+    path = tmp_path / 'script.py'
+    path.write_text(textwrap.dedent(script))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    # Open MPI refuses to run as root or to put more ranks than cores on a box
+    env.setdefault('OMPI_ALLOW_RUN_AS_ROOT', '1')
+    env.setdefault('OMPI_ALLOW_RUN_AS_ROOT_CONFIRM', '1')
+    env.setdefault('OMPI_MCA_rmaps_base_oversubscribe', '1')
+    env.setdefault('OMPI_MCA_btl_vader_single_copy_mechanism', 'none')
+    proc = subprocess.run([MPIRUN, '-n', str(nprocs), sys.executable, str(path)],
+                          env=env, capture_output=True, text=True, timeout=120)
+    assert proc.returncode == 0, proc.stdout + proc.stderr
+    return proc.stdout
+
+
+class TestMPI:
+
+    def test_work_params_loader(self, tmp_path):
+
+        out = mpirun(tmp_path, """
+            import numpy
+            from handympi import RunMasterSlave, MY_RANK
+
+            class Collector:
+                def __init__(self):
+                    self.results = {}
+                def __call__(self, i, result):
+                    self.results[i] = result
+
+            for params in (numpy.arange(5.0), numpy.array(['ab', 'c']),
+                           numpy.array([(1.0, 2), (3.0, 4)], dtype=[('a', 'f8'), ('b', 'i4')]),
+                           numpy.array(['2020-01-01'], dtype='datetime64[D]'), [1, 'x']):
+                x = RunMasterSlave(Collector, lambda p: str(p), workParamsLoader=lambda: params)
+                if MY_RANK == 0:
+                    assert x.results == {i: str(p) for i, p in enumerate(params)}, x.results
+            if MY_RANK == 0:
+                print('OK')
+            """)
+
+        assert out.split() == ['OK']
+
+    @pytest.mark.parametrize('mode', ['dynamic', 'static', 'hierarchical', 'stealing'])
+    def test_foreach_modes(self, tmp_path, mode):
+
+        out = mpirun(tmp_path, """
+            import numpy
+            from handympi import foreach, MY_RANK
+
+            # several runs in a row, so nothing one run leaves behind may upset the next
+            for n in (0, 1, 7, 200):
+                x = foreach(lambda v: v*v, list(range(n)), mode=%r)
+                y = foreach(lambda v: v*v, list(range(n)), mode=%r, resultDtype=numpy.float64)
+                if MY_RANK == 0:
+                    assert x == [i*i for i in range(n)], x
+                    assert isinstance(y, numpy.ndarray) and y.tolist() == [i*i for i in range(n)], y
+            if MY_RANK == 0:
+                print('OK')
+            """ % (mode, mode))
+
+        assert out.split() == ['OK']
+
+    def test_hierarchical_sub_masters(self, tmp_path):
+
+        out = mpirun(tmp_path, """
+            from handympi import MY_RANK
+            from handympi.mpi4_balancer import MPIBalancer, MPIWork
+
+            class Doubler(MPIWork):
+                def __init__(self, n):
+                    self.n = n
+                def getNumWorkItems(self):
+                    return self.n
+                def calcWorkResult(self, worknum):
+                    return worknum, 2*worknum
+                def masterBeforeWork(self):
+                    self.results = {}
+                def handleWorkResult(self, result, status):
+                    self.results[result[0]] = result[1]
+
+            class TwoNodes(MPIBalancer):
+                # pretend ranks 0-1 and 2-3 sit on different nodes
+                def splitNodes(self):
+                    return self.comm.Split(self.myid // 2, self.myid)
+
+            for n in (0, 5, 100):
+                work = Doubler(n)
+                TwoNodes(work).runHierarchical()
+                if MY_RANK == 0:
+                    assert work.results == {i: 2*i for i in range(n)}, work.results
+            if MY_RANK == 0:
+                print('OK')
+            """, nprocs=4)
+
+        assert out.split() == ['OK']